@@ -9,115 +9,260 @@ __author__ = "Tapan Hazarika"
 __license__ = "MIT"
 
 import polars as pl
-from io import BytesIO
 from zipfile import ZipFile
+from tempfile import SpooledTemporaryFile, NamedTemporaryFile
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 import os
 import logging
-from typing import Literal, Union
-from functools import lru_cache
+from typing import Literal, Union, List, Tuple, Optional, Dict, NamedTuple
+from collections import defaultdict
+from bisect import bisect_left
+
+_MASTER_PATH = os.path.join(os.path.dirname(__file__), "Shoonya_BFO_Modified_Master.parquet")
+
+
+def _make_session()-> requests.Session:
+    session = requests.Session()
+    session.mount(
+                "https://", 
+                HTTPAdapter(
+                        pool_connections= 1, 
+                        pool_maxsize= 1, 
+                        max_retries= Retry(total= 3, backoff_factor= 0.5)
+                        )
+                )
+    return session
+
+
+class _MasterIndex(NamedTuple):
+    tsym_to_tok: dict
+    key_to_row: dict
+    lotsize_by_symbol: dict
+    expiries: dict
+    expiry_strs: dict
+    strikediff: dict
 
 
 class ShoonyaBFOMaster:
     bfo_url = "https://api.shoonya.com/BFO_symbols.txt.zip"
+    spool_max_size = 5 * 1024 * 1024
+    timeout = (5, 30)
+    expiry_offsets = {"near": 0, "next": 1, "far": 2}
+    _session: Optional[requests.Session] = None
+    _CACHE: Dict[tuple, Tuple[pl.DataFrame, _MasterIndex]] = {}
 
     def __init__(self, hard_refresh=False) -> None:
         self.hard_refresh = hard_refresh
-        self.filepath = os.path.join(os.path.dirname(__file__), "Shoonya_BFO_Modified_Master.csv")
+        self.filepath = _MASTER_PATH
+        self.meta_path = _MASTER_PATH + ".etag"
+        self.raw_filepath = None
+        self.validators = ("", "")
         self.current_date = datetime.now().date()
 
         if self.hard_refresh:
-            self.load_master.cache_clear()
-        self.load_master()
+            self._CACHE.pop((self.filepath, self.current_date), None)
+        index = self._cache_entry()[1]
+        self._tsym_to_tok = index.tsym_to_tok
+        self._key_to_row = index.key_to_row
+        self._lotsize_by_symbol = index.lotsize_by_symbol
+        self._expiries = index.expiries
+        self._expiry_strs = index.expiry_strs
+        self._strikediff = index.strikediff
+
+    @staticmethod
+    def build_index(df: pl.DataFrame) -> _MasterIndex:
+        tsym_to_tok = dict(zip(df["TradingSymbol"], df["Token"]))
+        key_to_row = {}
+        lotsize_by_symbol = {}
+        expiry_sets = defaultdict(set)
+
+        for s, i, e, es, o, sp, tok, tsym, ls in zip(
+                                            df["Symbol_1"],
+                                            df["Instrument"],
+                                            df["Expiry"],
+                                            df["ExpiryStr"],
+                                            df["OptionType"],
+                                            df["StrikePrice"],
+                                            df["Token"],
+                                            df["TradingSymbol"],
+                                            df["LotSize"]
+                                            ):
+            key_to_row.setdefault((s, i, es, o, sp), (tok, tsym))
+            lotsize_by_symbol.setdefault(s, ls)
+            if e is not None:
+                expiry_sets[(s, i)].add((e, es))
+
+        expiry_dates = {}
+        expiry_strs = {}
+        for key, expiries in expiry_sets.items():
+            expiries = sorted(expiries)
+            expiry_dates[key] = [expiry for expiry, _ in expiries]
+            expiry_strs[key] = [expiry_str for _, expiry_str in expiries]
+
+        strikediff = df.filter(
+                            pl.col("StrikePrice") > 0
+                        ).group_by(
+                            "Symbol_1"
+                        ).agg(
+                            pl.col("StrikePrice").unique().sort().diff().min().alias("StrikeDiff")
+                        )
+        strikediff = dict(zip(strikediff["Symbol_1"], strikediff["StrikeDiff"]))
+
+        return _MasterIndex(
+                        tsym_to_tok= tsym_to_tok,
+                        key_to_row= key_to_row,
+                        lotsize_by_symbol= lotsize_by_symbol,
+                        expiries= expiry_dates,
+                        expiry_strs= expiry_strs,
+                        strikediff= strikediff
+                        )
     
     def is_latest(self) -> bool:
         file_time = datetime.fromtimestamp(os.path.getmtime(self.filepath)).date()
         logging.info("File modify date :: {}".format(file_time))
         return file_time == self.current_date
 
-    def download_master(self):
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if not self.hard_refresh and os.path.exists(self.filepath) and os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                etag, last_modified = (f.read().splitlines() + ["", ""])[:2]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def download_master(self)-> Tuple[Optional[int], Optional[pl.LazyFrame]]:
+        if ShoonyaBFOMaster._session is None:
+            ShoonyaBFOMaster._session = _make_session()
         try:
-            res = requests.get(self.bfo_url)
-            res.raise_for_status()
-            if res.status_code == 200:
-                with ZipFile(BytesIO(res.content), "r") as zip_file:
-                    file_1 = zip_file.namelist()[0]
-                    extension = file_1.split('.')[-1]
-                    with zip_file.open(file_1) as file:
-                        if extension == "txt" or extension == "csv":
-                            df = pl.read_csv(
-                                        source= file.read(),
-                                        schema= {
-                                                "Exchange" : pl.Utf8,
-                                                "Token" : pl.Utf8,
-                                                "LotSize" : pl.Utf8,
-                                                "Symbol" : pl.Utf8,
-                                                "TradingSymbol" : pl.Utf8,
-                                                "Expiry" : pl.Utf8,
-                                                "Instrument" : pl.Utf8,
-                                                "OptionType" : pl.Utf8,
-                                                "StrikePrice" : pl.Utf8,
-                                                "TickSize" : pl.Utf8
-                                            },
-                                        truncate_ragged_lines= True, 
-                                        has_header= True
-                                        )
-                            return df
-                        else:
-                            print(f"Unsupported File Type :: {extension}")
+            with self._session.get(
+                                self.bfo_url, 
+                                headers= self.conditional_headers(), 
+                                timeout= self.timeout, 
+                                stream= True
+                                ) as res:
+                res.raise_for_status()
+                if res.status_code == 304:
+                    return 304, None
+                if res.status_code == 200:
+                    self.validators = (
+                                    res.headers.get("ETag", ""),
+                                    res.headers.get("Last-Modified", "")
+                                    )
+                    with SpooledTemporaryFile(max_size= self.spool_max_size) as spool:
+                        res.raw.decode_content = True
+                        shutil.copyfileobj(res.raw, spool)
+                        spool.seek(0)
+                        with ZipFile(spool, "r") as zip_file:
+                            file_1 = zip_file.namelist()[0]
+                            extension = file_1.split('.')[-1]
+                            if extension == "txt" or extension == "csv":
+                                with zip_file.open(file_1) as file, NamedTemporaryFile(
+                                                                                dir= os.path.dirname(self.filepath),
+                                                                                suffix= ".csv",
+                                                                                delete= False
+                                                                                ) as raw:
+                                    self.raw_filepath = raw.name
+                                    shutil.copyfileobj(file, raw)
+                                lf = pl.scan_csv(
+                                            source= self.raw_filepath,
+                                            schema= {
+                                                    "Exchange" : pl.Utf8,
+                                                    "Token" : pl.Utf8,
+                                                    "LotSize" : pl.Utf8,
+                                                    "Symbol" : pl.Utf8,
+                                                    "TradingSymbol" : pl.Utf8,
+                                                    "Expiry" : pl.Utf8,
+                                                    "Instrument" : pl.Utf8,
+                                                    "OptionType" : pl.Utf8,
+                                                    "StrikePrice" : pl.Utf8,
+                                                    "TickSize" : pl.Utf8
+                                                },
+                                            truncate_ragged_lines= True, 
+                                            has_header= True
+                                            )
+                                return 200, lf
+                            else:
+                                print(f"Unsupported File Type :: {extension}")
         except Exception as e:
             print(f"Error Downloading :: {e}")
+            if self.raw_filepath and os.path.exists(self.raw_filepath):
+                os.remove(self.raw_filepath)
+            self.raw_filepath = None
+        return None, None
     
-    def load_master_from_file(self)-> pl.DataFrame:
-        df = pl.read_csv(source= self.filepath,
-                         dtypes= {
-                                "Exchange" : pl.Utf8,
-                                "Token" : pl.Utf8,
-                                "LotSize" : pl.Utf8,
-                                "Symbol" : pl.Utf8,
-                                "Symbol_1" : pl.Utf8,
-                                "TradingSymbol" : pl.Utf8,
-                                "Expiry" : pl.Utf8,
-                                "Instrument" : pl.Utf8,
-                                "OptionType" : pl.Utf8,
-                                "StrikePrice" : pl.Utf8,
-                                "TickSize" : pl.Utf8
-                            }
-                        )
-        return df
+    def load_master_from_file(self)-> pl.LazyFrame:
+        return pl.scan_parquet(source= self.filepath)
+    
+    def save_master(self, lf: pl.LazyFrame)-> pl.LazyFrame:
+        with NamedTemporaryFile(
+                            dir= os.path.dirname(self.filepath),
+                            suffix= ".parquet.tmp",
+                            delete= False
+                            ) as tmp:
+            tmp_path = tmp.name
+        try:
+            self.prepare_data(lf).sink_parquet(tmp_path, compression= "snappy")
+            if pl.scan_parquet(tmp_path).select(pl.len()).collect().item() == 0:
+                raise ValueError("Downloaded SymbolMaster is empty")
+            os.replace(tmp_path, self.filepath)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if self.raw_filepath and os.path.exists(self.raw_filepath):
+                os.remove(self.raw_filepath)
+            self.raw_filepath = None
+        # Only record the validators once the master they describe is in place.
+        with open(self.meta_path, "w") as f:
+            f.write("{}\n{}\n".format(*self.validators))
+        return self.load_master_from_file()
     
-    @lru_cache(maxsize=None)
     def load_master(self)-> pl.DataFrame:
-        if os.path.exists(self.filepath):
-            if not self.is_latest():
-                df = self.download_master()
-                if df.is_empty():
-                    logging.info("Download failed. Using Old SymbolMaster.")
-                    df = self.load_master_from_file()
-                else:
-                    df = self.prepare_data(df)
-                    if not df.is_empty():
-                        df.write_csv(self.filepath)
+        return self._cache_entry()[0]
+
+    def _cache_entry(self)-> Tuple[pl.DataFrame, _MasterIndex]:
+        key = (self.filepath, self.current_date)
+        if key not in self._CACHE:
+            df = self.refresh_master().collect()
+            # Only the current day's master is worth keeping around.
+            self._CACHE.clear()
+            self._CACHE[key] = (df, self.build_index(df))
+        return self._CACHE[key]
+
+    def refresh_master(self)-> pl.LazyFrame:
+        exists = os.path.exists(self.filepath)
+        needs_refresh = self.hard_refresh or not exists or not self.is_latest()
+
+        if needs_refresh:
+            status, lf = self.download_master()
+            if status == 304:
+                logging.info("SymbolMaster not modified on server.")
+                os.utime(self.filepath, None)
+            elif lf is None:
+                if not exists:
+                    raise RuntimeError("Download failed and no old SymbolMaster found.")
+                logging.info("Download failed. Using Old SymbolMaster.")
             else:
-                if self.hard_refresh:
-                    df = self.download_master()
-                    df = self.prepare_data(df)
-                    if not df.is_empty():
-                        df.write_csv(self.filepath)
-                else:
-                    df = self.load_master_from_file()
-        else:
-            df = self.download_master()
-            df = self.prepare_data(df)
-            if not df.is_empty():
-                df.write_csv(self.filepath)
-        return df
+                try:
+                    return self.save_master(lf)
+                except Exception as e:
+                    if not exists:
+                        raise
+                    logging.info("Error Preparing SymbolMaster :: {}. Using Old SymbolMaster.".format(e))
+        return self.load_master_from_file()
 
     @staticmethod
-    def prepare_data(dataframe: pl.DataFrame)-> pl.DataFrame: 
+    def prepare_data(lf: pl.LazyFrame)-> pl.LazyFrame: 
 
-        df = dataframe.lazy().with_columns(
+        df = lf.with_columns(
                                     pl.when(
                                         pl.col("TradingSymbol").str.contains(
                                             "SENSEX50"
@@ -128,11 +273,21 @@ class ShoonyaBFOMaster:
                                                 pl.col(
                                                     "TradingSymbol"
                                                        ).str.extract(
-                                                                pattern= r'^(.*?)(\d)'
+                                                                pattern= r'^([^0-9]+)'
                                                                 )
                                                             ).alias(
                                                             "Symbol_1"
                                                         )
+                                                            ).with_columns(
+                                                                pl.col(["Symbol_1", "TradingSymbol"]).str.to_uppercase(),
+                                                                pl.col("Expiry").str.to_date(format= "%d-%b-%Y", strict= False),
+                                                                pl.col("LotSize").cast(pl.Int64, strict= False),
+                                                                pl.col(["StrikePrice", "TickSize"]).cast(pl.Float64, strict= False)
+                                                            ).with_columns(
+                                                                pl.col("Expiry").dt.strftime(format= "%d-%b-%Y").str.to_uppercase().alias(
+                                                                    "ExpiryStr"
+                                                                ),
+                                                                pl.col(["Symbol_1", "Instrument", "OptionType"]).cast(pl.Categorical)
                                                             ).select(
                                                                 [
                                                                     "Exchange",
@@ -142,12 +297,13 @@ class ShoonyaBFOMaster:
                                                                     "Symbol_1",
                                                                     "TradingSymbol",
                                                                     "Expiry",
+                                                                    "ExpiryStr",
                                                                     "Instrument",
                                                                     "OptionType",
                                                                     "StrikePrice",
                                                                     "TickSize"
                                                                     ]
-                                                                ).collect()
+                                                                )
         
         return df
     
@@ -156,37 +312,19 @@ class ShoonyaBFOMaster:
             symbol: str=None,
             instrument: Literal["FUTIDX", "FUTSTK", "OPTIDX", "OPTSTK"]= "OPTIDX",
             expirytype: Literal["near", "next", "far", "all"]= "near"
-            )-> Union[str, list]:
-        df = self.load_master()
-        try:
-            all_expiry= df.lazy().select(
-                                        ["Symbol_1", "Expiry","Instrument"]
-                                    ).filter(
-                                        (pl.col("Symbol_1") == symbol.upper())
-                                        &
-                                        (pl.col("Instrument") == instrument)
-                                    ).with_columns(
-                                        pl.col("Expiry").str.to_date(format= "%d-%b-%Y")
-                                    ).select(
-                                        "Expiry"
-                                    ).filter(
-                                        pl.col("Expiry") >= self.current_date
-                                    ).unique().sort(
-                                        by="Expiry"
-                                        ).with_columns(
-                                            pl.col("Expiry").dt.strftime(format= "%d-%b-%Y").str.to_uppercase()
-                                        ).collect()
-            
-            if expirytype == "near":
-                return all_expiry.item(0,0)
-            elif expirytype == "next":
-                return all_expiry.item(1,0)
-            elif expirytype == "far":
-                return all_expiry.item(2,0)
-            elif expirytype == "all":
-                return all_expiry.to_series().to_list()
-        except (IndexError, Exception) as e:
-            logging.debug("Error Fetching Expiry :: {}".format(e)) 
+            )-> Union[str, list, None]:
+        if symbol is None:
+            return None
+        key = (symbol.upper(), instrument)
+        idx = bisect_left(self._expiries.get(key, []), self.current_date)
+        all_expiry = self._expiry_strs.get(key, [])
+        
+        if expirytype == "all":
+            return all_expiry[idx:]
+        offset = self.expiry_offsets.get(expirytype)
+        if offset is None or idx + offset >= len(all_expiry):
+            return None
+        return all_expiry[idx + offset]
     
     def get_tradingsymbol(
                     self,
@@ -194,28 +332,12 @@ class ShoonyaBFOMaster:
                     instrument: Literal["FUTIDX", "FUTSTK", "OPTIDX", "OPTSTK"],
                     expiry: str,
                     optiontype: str= "XX",        
-                    strikeprice: Union[int, str]= 0                      
-                    )-> str:
-        df = self.load_master()
-        try:
-            tsym = df.lazy().select(
-                                  ["Symbol_1", "TradingSymbol", "Expiry","Instrument", "OptionType", "StrikePrice"]  
-                                ).filter(
-                                    (pl.col("Symbol_1") == symbol.upper())
-                                    &
-                                    (pl.col("Instrument") == instrument)
-                                    &
-                                    (pl.col("Expiry") == expiry)
-                                    &
-                                    (pl.col("OptionType") == optiontype)
-                                    &
-                                    (pl.col("StrikePrice") == str(strikeprice))
-                                ).select(
-                                    "TradingSymbol"
-                                ).collect().item(0, 0)
-            return tsym
-        except (IndexError, Exception) as e:
-            logging.debug("Error Fetching TradingSymbol :: {}".format(e))
+                    strikeprice: Union[int, float, str]= 0                      
+                    )-> Optional[str]:
+        row = self._key_to_row.get(
+                                (symbol.upper(), instrument, expiry, optiontype, float(strikeprice))
+                                )
+        return row[1] if row else None
     
     def get_token(
                 self,
@@ -224,78 +346,52 @@ class ShoonyaBFOMaster:
                 instrument: Literal["FUTIDX", "FUTSTK", "OPTIDX", "OPTSTK"]= "OPTIDX",
                 expiry: str= None,
                 optiontype: str= "XX",        
-                strikeprice: Union[int, str]= 0 
-                )-> str:
-        df = self.load_master()
-        try:
-            if symbol and not tradingsymbol:
-                tkn = df.lazy().select(
-                                      ["Token", "Symbol_1",  "Expiry", "Instrument", "OptionType", "StrikePrice"]  
-                                    ).filter(
-                                        (pl.col("Symbol_1") == symbol.upper())
-                                        &
-                                        (pl.col("Instrument") == instrument)
-                                        &
-                                        (pl.col("Expiry") == expiry)
-                                        &
-                                        (pl.col("OptionType") == optiontype)
-                                        &
-                                        (pl.col("StrikePrice") == str(strikeprice))
-                                    ).select(
-                                        "Token"
-                                    ).collect().item(0, 0)
-                return tkn
-            elif tradingsymbol:
-                tkn= df.lazy().select(
-                                            ["Token", "TradingSymbol"]
-                                        ).filter(
-                                            (pl.col("TradingSymbol") == tradingsymbol.upper())
-                                        ).select(
-                                            "Token"
-                                        ).collect().item(0, 0)
-                
-                return tkn            
-        except (IndexError, Exception) as e:
-            logging.debug("Error Fetching Token :: {}".format(e))
+                strikeprice: Union[int, float, str]= 0 
+                )-> Optional[str]:
+        if tradingsymbol:
+            return self._tsym_to_tok.get(tradingsymbol.upper())
+        if symbol:
+            row = self._key_to_row.get(
+                                    (symbol.upper(), instrument, expiry, optiontype, float(strikeprice))
+                                    )
+            return row[0] if row else None
+        return None
+    
+    def _lookup_rows(
+                self,
+                keys: List[Tuple[str, str, str, str, Union[int, float, str]]]
+                )-> List[Optional[Tuple[str, str]]]:
+        return [
+            self._key_to_row.get(
+                            (symbol.upper(), instrument, expiry, optiontype, float(strikeprice))
+                            )
+            for symbol, instrument, expiry, optiontype, strikeprice in keys
+            ]
+    
+    def get_tokens_bulk(
+                    self,
+                    keys: List[Tuple[str, str, str, str, Union[int, float, str]]]
+                    )-> List[Optional[str]]:
+        return [row[0] if row else None for row in self._lookup_rows(keys)]
+    
+    def get_tradingsymbols_bulk(
+                            self,
+                            keys: List[Tuple[str, str, str, str, Union[int, float, str]]]
+                            )-> List[Optional[str]]:
+        return [row[1] if row else None for row in self._lookup_rows(keys)]
     
     def get_strikediff(
                     self,
                     symbol: str= None,
-                    )-> float:
-        df = self.load_master()
-
-        try:
-            strikediff= df.lazy().select(
-                                        ["Symbol_1", "StrikePrice"]
-                                    ).with_columns(
-                                        pl.col("StrikePrice").cast(dtype= pl.Float64)
-                                    ).filter(
-                                        (pl.col("Symbol_1") == symbol.upper())
-                                        &
-                                        (pl.col("StrikePrice") > 0)
-                                    ).select(
-                                        "StrikePrice"
-                                    ).unique().sort(by="StrikePrice").collect().to_series().diff(null_behavior="drop").abs().min()
-
-            return strikediff            
-        except (IndexError, Exception) as e:
-            logging.debug("Error Fetching Strikediff :: {}".format(e))
+                    )-> Optional[float]:
+        if symbol is None:
+            return None
+        return self._strikediff.get(symbol.upper())
     
     def get_lotsize(
                     self,
                     symbol: str= None,
-                    )-> float:
-        try:
-            df = self.load_master()
-
-            lotsize = df.lazy().select(
-                                        ["LotSize", "Symbol_1"]    
-                                    ).filter(
-                                        pl.col("Symbol_1") == symbol
-                                    ).select(
-                                        "LotSize"
-                                    ).collect().item(0, 0)
-            
-            return lotsize
-        except (IndexError, Exception) as e:
-            logging.debug("Error Fetching Lotsize :: {}".format(e))
+                    )-> Optional[int]:
+        if symbol is None:
+            return None
+        return self._lotsize_by_symbol.get(symbol.upper())